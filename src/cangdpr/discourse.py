@@ -51,6 +51,11 @@ class CanDiscourseClient(DiscourseClient):
 
         return decoded
 
+    def check(self):
+        data = self._get("/session/current.json")
+        if not data.get("current_user"):
+            raise DiscourseError(f"Not logged in as {self.api_username}")
+
     def create_api_key(self, username, description):
         data = {"key": {"username": username, "description": description}}
 
@@ -1,6 +1,11 @@
+import heapq
+import itertools
 import logging
 import os.path
 import stat
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 import click
 import yaml
@@ -11,8 +16,9 @@ from pydiscourse.exceptions import (
 )
 
 from .discourse import CanDiscourseClient
-from .indico import Indico
+from .indico import Indico, TokenExpiredError
 from .salesforce import CanSalesforce
+from .service import SOCKET_PATH, LookupServer, client, print_lookup
 
 SF_GDPR_OWNER = "00G4K000000gkG9UAI"  # Assignee: GDPR - Snap
 SF_COMPANY = "canonical"
@@ -29,11 +35,83 @@ SELECT u.id, u.username, ue.email
 """
 ).strip()
 
+DiscoursePlan = namedtuple("DiscoursePlan", "group,query,actions")
+
 yaml.add_representer(
     type(None), lambda self, _: self.represent_scalar("tag:yaml.org,2002:null", "")
 )
 
 
+def discourse_plan(discourse):
+    """Work out which changes a discourse needs for GDPR lookups, without changing it.
+
+    Returns None if the discourse does not support data explorer.
+    """
+    try:
+        queries = discourse.data_explorer_queries()
+    except DiscourseClientError as e:
+        # Anything but a missing plugin, e.g. an invalid key, is a real error
+        if e.response.status_code != 404:
+            raise e
+        return None
+
+    try:
+        group = discourse.group("gdpr_lookups")
+    except DiscourseClientError as e:
+        if "resource could not be found" not in str(e):
+            raise e
+        group = None
+
+    query = next((q for q in queries if q["name"] == "gdpr_email_lookup"), None)
+
+    actions = []
+    if not group:
+        actions.append("create gdpr_lookups group")
+    if not query:
+        actions.append("create GDPR lookup query")
+    if (
+        not group
+        or not query
+        or query["sql"] != DISCOURSE_USER_SQL
+        or group["id"] not in query["group_ids"]
+    ):
+        actions.append("set query SQL and permissions")
+
+    return DiscoursePlan(group, query, actions)
+
+
+def discourse_apply(discourse, username, plan):
+    """Carry out the actions from discourse_plan, returning the lookup query."""
+    group = plan.group
+    query = plan.query
+
+    if not group:
+        try:
+            group = discourse.add_group(
+                "gdpr_lookups",
+                "Permissions for GDPR Lookups",
+                owner_usernames=username,
+                visibility_level=4,
+                members_visibility_level=4,
+                mentionable_level=0,
+                messageable_level=0,
+            )
+        except DiscourseError as e:
+            if "Name has already been taken" not in str(e):
+                raise e
+            group = discourse.group("gdpr_lookups")
+
+    if not query:
+        query = discourse.data_explorer_create_query("gdpr_email_lookup")
+
+    if query["sql"] != DISCOURSE_USER_SQL or group["id"] not in query["group_ids"]:
+        query = discourse.data_explorer_edit_query(
+            query["id"], sql=DISCOURSE_USER_SQL, group_ids=group["id"]
+        )
+
+    return query
+
+
 class Context:
     def __init__(self, config, sid=None, dry=False, debug=False):
         self.toolconfig = config["tools"]["cangdpr"]
@@ -62,6 +140,8 @@ class Context:
         profile = self.toolconfig.get("profile", None)
         binary = self.toolconfig.get("binary", None)
         geckodriver = self.toolconfig.get("geckodriver", None)
+        bulk_threshold = self.toolconfig.get("bulk_threshold", 10000)
+        bulk_max_wait = self.toolconfig.get("bulk_max_wait", 3600)
         self.sf = CanSalesforce(
             SF_COMPANY,
             SF_GDPR_OWNER,
@@ -70,6 +150,8 @@ class Context:
             profile=profile,
             binary=binary,
             geckodriver=geckodriver,
+            bulk_threshold=bulk_threshold,
+            bulk_max_wait=bulk_max_wait,
         )
 
         if debug:
@@ -81,6 +163,28 @@ class Context:
             # This one is a bit too verbose
             # http.client.HTTPConnection.debuglevel = 1
 
+    def preflight(self):
+        """Check all backend credentials concurrently, raising one combined report."""
+        checks = [(f"discourse:{d.name}", d.check) for d in self.discourses]
+        checks.append(("indico", self.indico.check))
+        checks.append(("salesforce", self.sf.check))
+
+        with ThreadPoolExecutor(max_workers=len(checks)) as executor:
+            futures = [(name, executor.submit(check)) for name, check in checks]
+
+        failures = []
+        for name, future in futures:
+            error = future.exception()
+            if error:
+                failures.append(f"\t{name}: {error}")
+
+        if failures:
+            raise click.ClickException(
+                "Preflight check failed:\n" + "\n".join(failures)
+            )
+
+        return [name for name, _ in checks]
+
     def profile_urls_get(self, email):
         urls = []
         for discourse in self.discourses:
@@ -88,7 +192,11 @@ class Context:
             if user:
                 urls.append(discourse.format_user(user))
 
-        data = self.indico.user_by_email(email)
+        try:
+            data = self.indico.user_by_email(email)
+        except TokenExpiredError as e:
+            raise click.ClickException(str(e))
+
         if data:
             urls.append(self.indico.format_user(data[0]))
 
@@ -107,6 +215,10 @@ def main(ctx, debug, config, dry, sid):
 
     If no email is specified, Salesforce will be queried for pending tasks
     """
+    if ctx.invoked_subcommand == "client":
+        # The thin client talks to a running server, it needs no config or backends
+        return
+
     configpath = os.path.expanduser(config)
 
     # Check if the config file is locked to mode 600. Add a loophole in case it is being passed in
@@ -143,23 +255,70 @@ def lookup(ctxo, query_tasks, emails):
         if query_tasks:
             email = ctxo.sf.get_task_email(email)
 
-        urls = ctxo.profile_urls_get(email)
-        if len(urls) < 1:
-            print("{} has no account data".format(email))
-        else:
-            print("{}:\n\t{}".format(email, "\n\t".join(urls)))
+        print_lookup(email, ctxo.profile_urls_get(email))
+
+
+@main.command()
+@click.option("--socket", default=SOCKET_PATH, help="Unix socket location.")
+@click.pass_obj
+def serve(ctxo, socket):
+    """Serve lookups over a unix socket, keeping sessions warm."""
+    ctxo.preflight()
+
+    path = os.path.expanduser(socket)
+    try:
+        server = LookupServer(path, ctxo)
+    except OSError as e:
+        raise click.ClickException(str(e))
+
+    with server:
+        print(f"Listening on {path}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
 
 
 @main.command()
 @click.option(
     "--since", type=int, help="Look back N months instead of taking open items."
 )
+@click.option(
+    "--max-tasks",
+    type=click.IntRange(min=0),
+    help="Process at most N tasks, open tasks closest to their deadline first.",
+)
+@click.option(
+    "--time-budget",
+    type=click.IntRange(min=0),
+    help="Stop starting new tasks after N seconds.",
+)
 @click.pass_obj
-def sftasks(ctxo, since):
+def sftasks(ctxo, since, max_tasks, time_budget):
+    ctxo.preflight()
+
+    def key(record):
+        return (ctxo.sf.deadline(record), record.created)
+
     tasks = ctxo.sf.get_tasks(since)
+    if since:
+        # Completed tasks have no deadline left, keep streaming them in query order
+        tasks = itertools.islice(tasks, max_tasks)
+    elif max_tasks is not None:
+        # Work on the open tasks closest to their legal deadline first
+        tasks = heapq.nsmallest(max_tasks, tasks, key=key)
+    else:
+        tasks = sorted(tasks, key=key)
+
+    # The budget only covers processing, not fetching the tasks or logging in
+    started = time.monotonic()
 
     try:
-        for record in tasks:
+        for index, record in enumerate(tasks):
+            if time_budget is not None and time.monotonic() - started > time_budget:
+                print(f"Time budget exhausted after {index} tasks")
+                break
+
             urls = ctxo.profile_urls_get(record.email)
             if len(urls) < 1:
                 print(
@@ -170,8 +329,11 @@ def sftasks(ctxo, since):
                 ctxo.sf.mark_complete(record.id)
             else:
                 print(
-                    "{}: {}\n\t{}".format(
-                        record.email, ctxo.sf.task_url(record.id), "\n\t".join(urls)
+                    "{}: {} (due {})\n\t{}".format(
+                        record.email,
+                        ctxo.sf.task_url(record.id),
+                        ctxo.sf.deadline(record),
+                        "\n\t".join(urls),
                     )
                 )
 
@@ -179,6 +341,14 @@ def sftasks(ctxo, since):
         print("Discourse Error: ", str(e), e.request.url)
 
 
+@main.command()
+@click.pass_obj
+def check(ctxo):
+    """Check credentials for all configured backends."""
+    for name in ctxo.preflight():
+        print(f"{name}: ok")
+
+
 @main.command()
 @click.argument("username")
 @click.pass_obj
@@ -337,55 +507,19 @@ def newdiscourse(ctxo, alias, url, username):
 
     discourse = CanDiscourseClient(alias, config["services"]["discourse"][alias], {})
 
-    try:
-        queries = discourse.data_explorer_queries()
-        supports_dataexplorer = True
-    except DiscourseClientError:
-        supports_dataexplorer = False
-
-    if supports_dataexplorer:
+    plan = discourse_plan(discourse)
+    if plan:
         print("Discourse supports data explorer")
-        try:
-            print("Creating gdpr_lookups group...", end="", flush=True)
-            group = discourse.add_group(
-                "gdpr_lookups",
-                "Permissions for GDPR Lookups",
-                owner_usernames=username,
-                visibility_level=4,
-                members_visibility_level=4,
-                mentionable_level=0,
-                messageable_level=0,
-            )
-            print("done")
-        except DiscourseError as e:
-            if "Name has already been taken" not in str(e):
-                raise e
-            print("group already exists")
-            group = discourse.group("gdpr_lookups")
-
-        gdprquery = next(
-            (query for query in queries if query["name"] == "gdpr_email_lookup"), None
-        )
-
-        if not gdprquery:
-            print("GDPR lookup query missing, creating now...", end="", flush=True)
-            gdprquery = discourse.data_explorer_create_query("gdpr_email_lookup")
-            print("done")
-
-        print("Setting query SQL and permissions...", end="", flush=True)
-        if (
-            gdprquery["sql"] != DISCOURSE_USER_SQL
-            or group["id"] not in gdprquery["group_ids"]
-        ):
-            discourse.data_explorer_edit_query(
-                gdprquery["id"], sql=DISCOURSE_USER_SQL, group_ids=group["id"]
-            )
+        query = plan.query
+        if plan.actions:
+            print("Need to " + ", ".join(plan.actions) + "...", end="", flush=True)
+            query = discourse_apply(discourse, username, plan)
             print("done")
         else:
-            print("already correct")
+            print("gdpr_lookups group and query already correct")
 
         config["tools"]["cangdpr"]["discourses"][alias] = {
-            "dataquery_gdpr_id": gdprquery["id"]
+            "dataquery_gdpr_id": query["id"]
         }
     else:
         print(
@@ -397,5 +531,90 @@ def newdiscourse(ctxo, alias, url, username):
     print(yaml.dump(config))
 
 
+@main.command()
+@click.argument("manifest", type=click.File())
+@click.option("--check", is_flag=True, help="Only show what would be changed.")
+@click.option("--jobs", default=8, help="Number of discourses to process at once.")
+@click.pass_obj
+def newdiscourses(ctxo, manifest, check, jobs):
+    """
+    Set up or verify all discourses listed in MANIFEST concurrently
+
+    The manifest has a discourses mapping from alias to url, username and key. The
+    key may be omitted for discourses that are already in the config file.
+    """
+    entries = (yaml.safe_load(manifest) or {}).get("discourses") or {}
+    configured = ctxo.serviceconfig.get("discourse", {})
+
+    discourses = []
+    for alias, entry in entries.items():
+        entry = dict(configured.get(alias, {}), **(entry or {}))
+        if not all(entry.get(field) for field in ("url", "username", "key")):
+            raise click.UsageError(f"{alias} needs url, username and key")
+
+        if not entry["url"].startswith("http"):
+            entry["url"] = "https://" + entry["url"]
+
+        discourses.append(CanDiscourseClient(alias, entry, {}))
+
+    def provision(discourse):
+        started = time.monotonic()
+        plan = discourse_plan(discourse)
+        query = plan.query if plan else None
+        if plan and plan.actions and not check:
+            query = discourse_apply(discourse, discourse.api_username, plan)
+        return plan, query, time.monotonic() - started
+
+    config = {
+        "services": {"discourse": {}},
+        "tools": {"cangdpr": {"discourses": {}}},
+    }
+    failed = False
+
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        futures = [(d, executor.submit(provision, d)) for d in discourses]
+
+    for discourse, future in futures:
+        try:
+            plan, query, elapsed = future.result()
+        except Exception as e:
+            print(f"{discourse.name}: failed ({e})")
+            failed = True
+            continue
+
+        if not plan:
+            summary = "no data explorer, needs moderator permissions"
+        elif not plan.actions:
+            summary = "up to date"
+        elif check:
+            summary = "needs to " + ", ".join(plan.actions)
+        else:
+            summary = "did " + ", ".join(plan.actions)
+
+        toolconfig = {"dataquery_gdpr_id": query["id"]} if query else None
+
+        print(f"{discourse.name}: {summary} ({elapsed:.1f}s)")
+
+        if check and plan and plan.actions:
+            # Leave it out, an empty entry would mean there is no data explorer
+            continue
+
+        config["services"]["discourse"][discourse.name] = {
+            "url": discourse.host,
+            "username": discourse.api_username,
+            "key": discourse.api_key,
+        }
+        config["tools"]["cangdpr"]["discourses"][discourse.name] = toolconfig
+
+    print("\nHere is your config\n")
+    print(yaml.dump(config))
+
+    if failed:
+        raise click.ClickException("Some discourses could not be processed")
+
+
+main.add_command(client)
+
+
 if __name__ == "__main__":
     main(prog="cangdpr")
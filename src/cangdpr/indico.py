@@ -1,28 +1,46 @@
 import json
-import sys
 from urllib.parse import urljoin
 
 import requests
 
 
+class TokenExpiredError(Exception):
+    pass
+
+
 class Indico:
     def __init__(self, config):
         self.base = config["url"]
         self.token = config["key"]
+        self.session = requests.Session()
 
-    def user_by_email(self, email):
+    def _search(self, email):
         headers = {"Authorization": "Bearer " + self.token}
         data = {"email": email, "exact": "true"}
 
-        r = requests.get(
+        return self.session.get(
             urljoin(self.base, "/user/search/"),
             headers=headers,
             params=data,
             allow_redirects=False,
         )
-        if "location" in r.headers and "/login/" in r.headers["location"]:
-            print("Your token has expired")
-            sys.exit(1)
+
+    @staticmethod
+    def _token_expired(r):
+        return "location" in r.headers and "/login/" in r.headers["location"]
+
+    def check(self):
+        # Search for an address that cannot exist, this is exactly what lookups do
+        r = self._search("gdpr-preflight@example.invalid")
+        if self._token_expired(r):
+            raise TokenExpiredError("Your token has expired")
+        if r.status_code != 200:
+            raise Exception(f"User search failed with status {r.status_code}")
+
+    def user_by_email(self, email):
+        r = self._search(email)
+        if self._token_expired(r):
+            raise TokenExpiredError("Your token has expired")
 
         try:
             data = r.json()
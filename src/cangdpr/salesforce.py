@@ -1,6 +1,11 @@
+import csv
+import io
 import json
 import logging
+import tempfile
+import time
 from collections import namedtuple
+from datetime import datetime, timedelta
 from urllib.parse import urljoin
 
 import requests
@@ -11,9 +16,12 @@ from selenium.webdriver.support.ui import WebDriverWait
 
 logger = logging.getLogger(__name__)
 
+# Legal response deadline for GDPR requests without an explicit due date
+GDPR_RESPONSE_DAYS = 30
+
 
 class CanSalesforce:
-    Record = namedtuple("SFRecord", "id,email")
+    Record = namedtuple("SFRecord", "id,email,created,due")
 
     def __init__(
         self,
@@ -24,6 +32,10 @@ class CanSalesforce:
         profile=None,
         binary=None,
         geckodriver=None,
+        bulk_threshold=10000,
+        bulk_poll_interval=2,
+        bulk_max_wait=3600,
+        bulk_chunk_size=50000,
     ):
         self.company = company
         self.gdpr_owner = gdpr_owner
@@ -32,6 +44,11 @@ class CanSalesforce:
         self.profile = profile
         self.binary = binary
         self.geckodriver = geckodriver
+        self.bulk_threshold = bulk_threshold
+        self.bulk_poll_interval = bulk_poll_interval
+        self.bulk_max_wait = bulk_max_wait
+        self.bulk_chunk_size = bulk_chunk_size
+        self.session = requests.Session()
 
     @property
     def base_url(self):
@@ -45,12 +62,141 @@ class CanSalesforce:
     def _soql_query(self, query):
         soql_query_url = urljoin(self.base_url, "query")
         logger.debug("SOQL QUERY IS: " + query)
-        return requests.get(soql_query_url, headers=self.headers, params={"q": query})
+        return self.session.get(
+            soql_query_url, headers=self.headers, params={"q": query}
+        )
+
+    def _soql_records(self, query):
+        r = self._soql_query(query)
+
+        while True:
+            try:
+                data = r.json()
+            except json.decoder.JSONDecodeError:
+                raise Exception(
+                    f"SOQL query failed with status {r.status_code}:\n{r.text}"
+                )
+
+            if isinstance(data, list) and len(data) > 0 and "errorCode" in data[0]:
+                raise Exception(
+                    "{}: {}".format(data[0]["errorCode"], data[0]["message"])
+                )
+
+            if r.status_code != 200:
+                raise Exception(
+                    f"SOQL query failed with status {r.status_code}:\n{r.text}"
+                )
+
+            yield from data["records"]
+
+            if data.get("done", True):
+                break
+
+            r = self.session.get(
+                urljoin(self.base_url, data["nextRecordsUrl"]), headers=self.headers
+            )
+
+    def _soql_count(self, query):
+        r = self._soql_query(query)
+        data = r.json()
+
+        if isinstance(data, list) and len(data) > 0 and "errorCode" in data[0]:
+            raise Exception("{}: {}".format(data[0]["errorCode"], data[0]["message"]))
+
+        return data["totalSize"]
+
+    def _bulk_query(self, query):
+        """Run a query through Bulk API 2.0 and yield result rows as dicts.
+
+        Each CSV result chunk is downloaded to a temporary file before its rows are
+        yielded, so memory stays bounded and no connection is held open while the caller
+        works through the rows.
+        """
+        jobs_url = urljoin(self.base_url, "jobs/query")
+        headers = self.headers
+        jsonheaders = headers.copy()
+        jsonheaders["Content-Type"] = "application/json"
+
+        logger.debug("BULK QUERY IS: " + query)
+        r = self.session.post(
+            jobs_url, headers=jsonheaders, json={"operation": "query", "query": query}
+        )
+        if r.status_code != 200:
+            raise Exception("Could not create bulk query job:\n" + r.text)
+
+        job_url = jobs_url + "/" + r.json()["id"]
+
+        deadline = time.monotonic() + self.bulk_max_wait
+        while True:
+            r = self.session.get(job_url, headers=headers)
+            if r.status_code != 200:
+                raise Exception("Could not get bulk query job status:\n" + r.text)
+
+            job = r.json()
+            logger.debug(f"Bulk job {job['id']} is {job['state']}")
+            if job["state"] == "JobComplete":
+                break
+            elif job["state"] in ("Failed", "Aborted"):
+                raise Exception(
+                    "Bulk query job {}: {}".format(
+                        job["state"], job.get("errorMessage", "")
+                    )
+                )
+            elif time.monotonic() > deadline:
+                self.session.patch(
+                    job_url, headers=jsonheaders, json={"state": "Aborted"}
+                )
+                raise Exception(
+                    "Bulk query job {} did not complete within {} seconds".format(
+                        job["id"], self.bulk_max_wait
+                    )
+                )
+            time.sleep(self.bulk_poll_interval)
+
+        locator = None
+        while True:
+            params = {"maxRecords": self.bulk_chunk_size}
+            if locator:
+                params["locator"] = locator
+
+            with tempfile.TemporaryFile() as chunk:
+                with self.session.get(
+                    job_url + "/results", headers=headers, params=params, stream=True
+                ) as r:
+                    if r.status_code != 200:
+                        raise Exception(
+                            "Could not fetch bulk query results:\n" + r.text
+                        )
+
+                    for block in r.iter_content(chunk_size=65536):
+                        chunk.write(block)
+                    locator = r.headers.get("Sforce-Locator")
+
+                chunk.seek(0)
+                yield from csv.DictReader(
+                    io.TextIOWrapper(chunk, encoding="utf-8", newline="")
+                )
+
+            if not locator or locator == "null":
+                break
 
     def ensure_sid(self):
         if not self.sid:
             self.sid = self._get_sid_cookie()
 
+    def check(self):
+        r = self.session.get(self.base_url, headers=self.headers)
+        if r.status_code != 200:
+            try:
+                data = r.json()
+            except json.decoder.JSONDecodeError:
+                data = None
+            if isinstance(data, list) and len(data) > 0 and "errorCode" in data[0]:
+                raise Exception(
+                    "{}: {}".format(data[0]["errorCode"], data[0]["message"])
+                )
+            raise Exception(f"Session check failed with status {r.status_code}")
+
     def _get_sid_cookie(self):
         def waiter(driver):
             return driver.current_url.startswith(
@@ -109,31 +255,42 @@ class CanSalesforce:
 
     def get_tasks(self, since=None):
         if since:
-            query = " ".join(
+            where = " ".join(
                 [
-                    f"SELECT Id,Subject,WhatId,Email__c FROM Task WHERE OwnerId='{self.gdpr_owner}' AND",
-                    f"Status='Completed' AND CreatedDate = LAST_N_MONTHS:{since}",
+                    f"OwnerId='{self.gdpr_owner}' AND Status='Completed' AND",
+                    f"CreatedDate = LAST_N_MONTHS:{since}",
                 ]
             )
-
         else:
-            query = "SELECT Id,Subject,WhatId,Email__c FROM Task WHERE OwnerId='{}' AND Status='Not Started'"
-
-        r = self._soql_query(query.format(self.gdpr_owner))
-
-        try:
-            data = r.json()
-        except json.decoder.JSONDecodeError as e:
-            print(e)
-            print(r.text)
-
-        if isinstance(data, list) and len(data) > 0 and "errorCode" in data[0]:
-            raise Exception("{}: {}".format(data[0]["errorCode"], data[0]["message"]))
-
-        return map(
-            lambda record: CanSalesforce.Record(record["Id"], record["Email__c"]),
-            data["records"],
-        )
+            where = f"OwnerId='{self.gdpr_owner}' AND Status='Not Started'"
+
+        fields = "Id,Subject,WhatId,Email__c,CreatedDate,ActivityDate"
+        query = f"SELECT {fields} FROM Task WHERE {where}"
+
+        # Only audits over completed tasks get large enough for the bulk API to pay off
+        if (
+            since
+            and self.bulk_threshold is not None
+            and self._soql_count(f"SELECT COUNT() FROM Task WHERE {where}")
+            > self.bulk_threshold
+        ):
+            return map(self._record, self._bulk_query(query))
+
+        return map(self._record, self._soql_records(query))
+
+    @staticmethod
+    def _record(record):
+        # REST returns null for empty values, the bulk CSV an empty string. Only the
+        # date part of CreatedDate matters for the deadline.
+        created = datetime.strptime(record["CreatedDate"][:10], "%Y-%m-%d").date()
+        due = record["ActivityDate"]
+        due = datetime.strptime(due, "%Y-%m-%d").date() if due else None
+        email = record["Email__c"] or None
+        return CanSalesforce.Record(record["Id"], email, created, due)
+
+    @staticmethod
+    def deadline(record):
+        return record.due or record.created + timedelta(days=GDPR_RESPONSE_DAYS)
 
     def mark_complete(self, taskId):
         if self.dry:
@@ -142,7 +299,7 @@ class CanSalesforce:
         headers = self.headers.copy()
         headers["Content-Type"] = "application/json"
         task_url = urljoin(self.base_url, "sobjects/Task/{}".format(taskId))
-        r = requests.patch(task_url, headers=headers, json={"Status": "Completed"})
+        r = self.session.patch(task_url, headers=headers, json={"Status": "Completed"})
         if r.status_code != 204:
             raise Exception("Could not mark task completed:\n" + r.text)
 
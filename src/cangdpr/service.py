@@ -0,0 +1,131 @@
+import json
+import logging
+import os
+import socket
+import socketserver
+import stat
+
+import click
+
+# Only the standard library and click are imported here, so the thin client starts
+# quickly without loading the backends.
+
+SOCKET_PATH = "~/.cangdpr.sock"
+
+logger = logging.getLogger(__name__)
+
+
+class LookupHandler(socketserver.StreamRequestHandler):
+    """Answers one JSON request per line with one JSON response per line.
+
+    Requests look like {"emails": [...], "query_tasks": false}, responses like
+    {"results": [{"email": ..., "urls": [...]}]} or {"error": "..."}.
+    """
+
+    # Lookups are served one at a time, don't let a stalled client block the others
+    timeout = 30
+
+    def handle(self):
+        try:
+            for line in self.rfile:
+                try:
+                    request = json.loads(line)
+                    response = {"results": self.server.lookup(**request)}
+                except Exception as e:
+                    logger.exception("Lookup failed")
+                    response = {"error": str(e)}
+
+                self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+                self.wfile.flush()
+        except socket.timeout:
+            logger.warning("Client timed out, closing connection")
+
+
+class LookupServer(socketserver.UnixStreamServer):
+    def __init__(self, path, ctxo):
+        self.ctxo = ctxo
+        self.path = path
+
+        if os.path.lexists(path):
+            if not stat.S_ISSOCK(os.lstat(path).st_mode):
+                raise OSError(f"{path} exists and is not a socket")
+
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                try:
+                    sock.connect(path)
+                except ConnectionRefusedError:
+                    # Left over from a server that did not shut down cleanly
+                    os.unlink(path)
+                else:
+                    raise OSError(f"Another server is already listening on {path}")
+
+        super().__init__(path, LookupHandler)
+        os.chmod(path, 0o600)
+        self.inode = os.lstat(path).st_ino
+
+    def lookup(self, emails, query_tasks=False):
+        results = []
+        for email in emails:
+            if query_tasks:
+                email = self.ctxo.sf.get_task_email(email)
+
+            results.append({"email": email, "urls": self.ctxo.profile_urls_get(email)})
+        return results
+
+    def server_close(self):
+        super().server_close()
+        # Only remove the socket if it is still ours
+        if os.path.lexists(self.path) and os.lstat(self.path).st_ino == self.inode:
+            os.unlink(self.path)
+
+
+def lookup_remote(path, emails, query_tasks=False):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+        request = {"emails": list(emails), "query_tasks": query_tasks}
+        sock.sendall(json.dumps(request).encode("utf-8") + b"\n")
+
+        with sock.makefile("rb") as fd:
+            line = fd.readline()
+
+    if not line:
+        raise Exception("Server closed connection")
+
+    response = json.loads(line)
+
+    if "error" in response:
+        raise Exception(response["error"])
+
+    return response["results"]
+
+
+def print_lookup(email, urls):
+    if len(urls) < 1:
+        print("{} has no account data".format(email))
+    else:
+        print("{}:\n\t{}".format(email, "\n\t".join(urls)))
+
+
+@click.command()
+@click.option(
+    "--socket", "socket_path", default=SOCKET_PATH, help="Unix socket location."
+)
+@click.option(
+    "-l",
+    "--query-tasks",
+    is_flag=True,
+    help="EMAILS are task ids, not email addresses.",
+)
+@click.argument("emails", required=False, nargs=-1)
+def client(socket_path, query_tasks, emails):
+    """Look up emails through a running serve command."""
+    path = os.path.expanduser(socket_path)
+    try:
+        results = lookup_remote(path, emails, query_tasks)
+    except OSError as e:
+        raise click.ClickException(f"Could not connect to {path}: {e}")
+    except Exception as e:
+        raise click.ClickException(str(e))
+
+    for result in results:
+        print_lookup(result["email"], result["urls"])